@@ -3,15 +3,19 @@
 # -------
 # FastAPI app for submitting “send_email” jobs with high/low priority,
 # storing them in Redis, and exposing endpoints to enqueue and check status.
+from contextlib import asynccontextmanager
 from typing import Literal
 from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
+import time
 import uuid
-import json
 import os
 
-import redis
+import msgpack
+import redis.asyncio as aioredis
+import zstandard
 from fastapi import FastAPI, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 
 # 1) Load environment variables from .env
@@ -19,15 +23,45 @@ load_dotenv()
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB   = int(os.getenv("REDIS_DB",   "0"))
+REDIS_POOL = int(os.getenv("REDIS_POOL", "64"))
+# Set when Redis runs on the same host (redis.conf: unixsocket /var/run/redis/redis.sock)
+REDIS_UNIX_SOCKET = os.getenv("REDIS_UNIX_SOCKET", "")
 
-# 2) Initialize Redis client (decode_responses=True returns strings, not bytes)
-r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+# 2) Initialize async Redis clients so handlers never block the event loop
+#    (decode_responses=True returns strings, not bytes).
+#    The payload field holds MessagePack bytes, so whole-hash reads go through r_raw.
+#    Each client gets a bounded pool of keep-alive connections; BlockingConnectionPool
+#    makes requests wait for a free connection instead of failing under load spikes.
+#    A Unix domain socket, when configured, skips the TCP/IP stack entirely.
+POOL_KWARGS = dict(
+    db=REDIS_DB,
+    max_connections=REDIS_POOL,
+    socket_timeout=5,
+    health_check_interval=30
+)
+if REDIS_UNIX_SOCKET:
+    POOL_KWARGS.update(connection_class=aioredis.UnixDomainSocketConnection, path=REDIS_UNIX_SOCKET)
+else:
+    POOL_KWARGS.update(host=REDIS_HOST, port=REDIS_PORT, socket_keepalive=True)
+r     = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(decode_responses=True, **POOL_KWARGS))
+r_raw = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(decode_responses=False, **POOL_KWARGS))
 
 # 3) Initialize FastAPI
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Release the Redis connection pools when the server stops.
+    """
+    yield
+    await r.close(close_connection_pool=True)
+    await r_raw.close(close_connection_pool=True)
+
+
 app = FastAPI(
     title="Custom Job Queue API",
     description="Submit & track high/low priority 'send_email' jobs in Redis",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # --- 4. Pydantic models for request/response validation ---
@@ -59,73 +93,122 @@ class JobStatusResponse(BaseModel):
 
 # --- 5. Helper functions ---
 
-def _current_utc_iso() -> str:
-    return datetime.utcnow().isoformat()
+# Messages longer than this (in UTF-8 bytes) are zstd-compressed before storing.
+# One compressor/decompressor per process; handlers all run on the event loop
+# thread, so the instances are never used concurrently.
+COMPRESS_MIN_BYTES = 512
+_zstd_compressor   = zstandard.ZstdCompressor(level=3)
+_zstd_decompressor = zstandard.ZstdDecompressor()
+
+# Pending jobs live in one sorted set scored by priority band + available_after
+# (epoch ms), so every high job sorts before every low one (see worker.py).
+# Each submission also pushes a token onto NOTIFY_KEY to wake an idle worker.
+READY_KEY = "jobs:ready"
+PRIORITY_BAND = {"high": 0, "low": 10 ** 13}
+NOTIFY_KEY = "jobs:notify"
 
 
-def _make_job_entry(data: JobRequest) -> tuple[str, dict[str, str]]:
+def _current_utc_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _ready_score(priority: str, available_after_ms: int) -> int:
+    return PRIORITY_BAND[priority] + available_after_ms
+
+
+def _make_job_entry(data: JobRequest) -> tuple[str, int, tuple[str | bytes, ...]]:
     """
-    Create a new Redis hash key and dictionary for this job.
-    All values are stored as strings.
+    Create a new job_id, its READY_KEY score, and the fields of its Redis hash
+    as a flat field/value tuple, already in HSET argument order.
+    All values are stored as strings, except payload (MessagePack bytes).
+    A long message is stored zstd-compressed and flagged with payload_enc="zstd".
     """
-    job_id = str(uuid.uuid4())
-    now_iso = _current_utc_iso()
-    job_hash_key = f"jobs:hash:{job_id}"
-
-    job = {
-        "job_id": job_id,
-        "job_type": data.job_type,
-        "priority": data.priority,
-        # Store payload as a JSON string
-        "payload": data.payload.json(),
-        "status": "pending",
-        "retry_count": "0",
-        "created_ts": now_iso,
-        "picked_ts": "",
-        "completed_ts": "",
-        "available_after": now_iso
-    }
-    return job_hash_key, job
+    job_id = uuid.uuid4().hex  # 32 chars vs 36 for the dashed form; repeated in every key
+    now = _current_utc_ms()
+    now_ms = str(now)
 
+    payload = data.payload.model_dump()
+    message = payload["message"].encode()
+    compressed = len(message) > COMPRESS_MIN_BYTES
+    if compressed:
+        # MessagePack stores bytes natively, so no base64 step is needed
+        payload["message"] = _zstd_compressor.compress(message)
 
-def _enqueue_job(job_hash_key: str, job: dict[str, str]) -> None:
+    fields = (
+        "job_id", job_id,
+        "job_type", data.job_type,
+        "priority", data.priority,
+        # Store payload as MessagePack bytes (smaller and faster than JSON)
+        "payload", msgpack.packb(payload),
+        "status", "pending",
+        "retry_count", "0",
+        "created_ts", now_ms,
+        "picked_ts", "",
+        "completed_ts", "",
+        "available_after", now_ms
+    )
+    if compressed:
+        fields += ("payload_enc", "zstd")
+    return job_id, _ready_score(data.priority, now), fields
+
+
+async def _enqueue_job(job_id: str, score: int, fields: tuple[str | bytes, ...]) -> None:
     """
-    Save the job in Redis and push its ID onto the high- or low-priority list.
+    Save the job in Redis and add its ID to READY_KEY with the given score.
+    All commands go out in one MULTI/EXEC round-trip, so a job is never
+    stored without being queued (or queued without being stored).
     """
-    # 1) Save the hash
-    r.hset(job_hash_key, mapping=job)
+    pipe = r.pipeline(transaction=True)
+    # 1) Save the hash; raw HSET skips redis-py's mapping → argument list conversion
+    pipe.execute_command("HSET", f"jobs:hash:{job_id}", *fields)
+    # 2) Add job_id to the ready set
+    pipe.zadd(READY_KEY, {job_id: score})
+    # 3) Wake an idle worker; a single pending token is enough, so cap the list at one
+    pipe.lpush(NOTIFY_KEY, 1)
+    pipe.ltrim(NOTIFY_KEY, 0, 0)
+    await pipe.execute()
 
-    # 2) Push job_id onto the appropriate priority queue
-    if job["priority"] == "high":
-        r.lpush("jobs:queue:high", job["job_id"])
-    else:
-        r.lpush("jobs:queue:low", job["job_id"])
+
+def _decode_job_hash(raw_hash: dict[bytes, bytes]) -> dict[str, str | bytes]:
+    """
+    Decode a hash read through r_raw: every field is UTF-8 text
+    except payload, which stays as MessagePack bytes.
+    """
+    return {
+        k.decode(): v if k == b"payload" else v.decode()
+        for k, v in raw_hash.items()
+    }
 
 
-def _parse_job_hash_to_response(job_hash: dict[str, str]) -> JobStatusResponse:
+def _parse_job_hash_to_response(job_hash: dict[str, str | bytes]) -> dict:
     """
-    Convert a Redis hash (all fields are strings) into a JobStatusResponse.
-    Timestamps are ISO strings; "" → None.
+    Convert a decoded Redis hash into a dict shaped like JobStatusResponse.
+    The payload was validated on submission, so it is unpacked once and
+    passed through without building Pydantic models again.
+    Timestamps are stored as epoch milliseconds and only become
+    datetimes here, at the response boundary; "" → None.
     """
-    # Parse payload JSON string back to dict
-    payload_dict = json.loads(job_hash["payload"])
+    # Unpack MessagePack payload back to dict
+    payload_dict = msgpack.unpackb(job_hash["payload"], raw=False)
+    if job_hash.get("payload_enc") == "zstd":
+        payload_dict["message"] = _zstd_decompressor.decompress(payload_dict["message"]).decode()
 
     def _parse_ts(field: str) -> datetime | None:
         val = job_hash.get(field, "")
-        return datetime.fromisoformat(val) if val else None
-
-    return JobStatusResponse(
-        job_id          = job_hash["job_id"],
-        job_type        = job_hash["job_type"],
-        priority        = job_hash["priority"],
-        payload         = JobPayload(**payload_dict),
-        status          = job_hash["status"],
-        retry_count     = int(job_hash["retry_count"]),
-        created_ts      = datetime.fromisoformat(job_hash["created_ts"]),
-        picked_ts       = _parse_ts("picked_ts"),
-        completed_ts    = _parse_ts("completed_ts"),
-        available_after = datetime.fromisoformat(job_hash["available_after"])
-    )
+        return datetime.utcfromtimestamp(int(val) / 1000) if val else None
+
+    return {
+        "job_id":          job_hash["job_id"],
+        "job_type":        job_hash["job_type"],
+        "priority":        job_hash["priority"],
+        "payload":         payload_dict,
+        "status":          job_hash["status"],
+        "retry_count":     int(job_hash["retry_count"]),
+        "created_ts":      _parse_ts("created_ts"),
+        "picked_ts":       _parse_ts("picked_ts"),
+        "completed_ts":    _parse_ts("completed_ts"),
+        "available_after": _parse_ts("available_after")
+    }
 
 # --- 6. API Endpoints ---
 
@@ -149,21 +232,24 @@ async def submit_job(job_req: JobRequest):
     }
 
     Returns (201):
-    { "job_id": "<uuid>", "status": "enqueued" }
+    { "job_id": "<32-char hex uuid>", "status": "enqueued" }
     """
-    job_hash_key, job = _make_job_entry(job_req)
-    _enqueue_job(job_hash_key, job)
-    return {"job_id": job["job_id"], "status": "enqueued"}
+    job_id, score, fields = _make_job_entry(job_req)
+    await _enqueue_job(job_id, score, fields)
+    return {"job_id": job_id, "status": "enqueued"}
 
 
 @app.get(
     "/jobs/status/{job_id}",
-    response_model=JobStatusResponse,
+    # Serialized directly by orjson; JobStatusResponse only documents the shape
+    response_model=None,
+    response_class=ORJSONResponse,
+    responses={status.HTTP_200_OK: {"model": JobStatusResponse}},
     summary="Get current status of a job"
 )
 async def job_status(job_id: str):
     """
-    Path parameter: job_id (UUID)
+    Path parameter: job_id (hex UUID)
 
     If the job exists, returns JSON like:
     {
@@ -182,10 +268,12 @@ async def job_status(job_id: str):
     If not found, returns 404.
     """
     job_key = f"jobs:hash:{job_id}"
-    if not r.exists(job_key):
+    # HGETALL returns {} for a missing key, so no separate EXISTS round-trip
+    raw_hash = await r_raw.hgetall(job_key)
+    if not raw_hash:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Job not found"
         )
-    job_hash = r.hgetall(job_key)
-    return _parse_job_hash_to_response(job_hash)
+    job_hash = _decode_job_hash(raw_hash)
+    return ORJSONResponse(_parse_job_hash_to_response(job_hash))
@@ -1,16 +1,21 @@
 # worker.py
 # ---------
-# Worker process that continuously polls Redis for jobs,
+# Worker process that blocks on Redis for jobs,
 # processes them in strict priority order (high then low),
 # and implements exponential backoff (max 3 retries) for “send_email”.
+# Up to WORKER_CONCURRENCY jobs run at once on a single asyncio event loop.
 
-import redis
+import asyncio
+from email.message import EmailMessage
 import time
-import json
-import datetime
 import random
+import uuid
 import os
 
+import aiosmtplib
+import msgpack
+import redis.asyncio as aioredis
+import zstandard
 from dotenv import load_dotenv
 
 # 1) Load environment variables from .env
@@ -18,129 +23,294 @@ load_dotenv()
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB   = int(os.getenv("REDIS_DB",   "0"))
+REDIS_POOL = int(os.getenv("REDIS_POOL", "64"))
+# Set when Redis runs on the same host (redis.conf: unixsocket /var/run/redis/redis.sock)
+REDIS_UNIX_SOCKET = os.getenv("REDIS_UNIX_SOCKET", "")
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "10"))
+WORKER_PREFETCH    = int(os.getenv("WORKER_PREFETCH", str(WORKER_CONCURRENCY)))
+# Leave SMTP_HOST unset to simulate sending (sleep 2s + 20% random failure)
+SMTP_HOST     = os.getenv("SMTP_HOST", "")
+SMTP_PORT     = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME") or None
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD") or None
+SMTP_FROM     = os.getenv("SMTP_FROM", "noreply@localhost")
 
-# 2) Initialize Redis client
-r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+# 2) Initialize async Redis clients; r_raw returns bytes so the MessagePack payload survives.
+#    Both use a bounded pool of keep-alive connections (socket_timeout must stay
+#    above FETCH_TIMEOUT, or the blocking BLPOP would time out client-side).
+#    REDIS_POOL should exceed WORKER_CONCURRENCY: the fetcher holds one connection.
+#    A Unix domain socket, when configured, skips the TCP/IP stack entirely.
+POOL_KWARGS = dict(
+    db=REDIS_DB,
+    max_connections=REDIS_POOL,
+    socket_timeout=5,
+    health_check_interval=30
+)
+if REDIS_UNIX_SOCKET:
+    POOL_KWARGS.update(connection_class=aioredis.UnixDomainSocketConnection, path=REDIS_UNIX_SOCKET)
+else:
+    POOL_KWARGS.update(host=REDIS_HOST, port=REDIS_PORT, socket_keepalive=True)
+r     = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(decode_responses=True, **POOL_KWARGS))
+r_raw = aioredis.Redis(connection_pool=aioredis.BlockingConnectionPool(decode_responses=False, **POOL_KWARGS))
 
 # 3) Base delay (in seconds) for exponential backoff
 BACKOFF_BASE = 1
 
-def _current_utc_iso() -> str:
-    return datetime.datetime.utcnow().isoformat()
+# 4) Seconds an idle worker waits for a submission token on NOTIFY_KEY before
+#    checking READY_KEY again; this bounds how late a due retry starts on an idle worker
+FETCH_TIMEOUT = 1
 
-def _fetch_next_job_id() -> str | None:
+# 5) Every pending job (new or retrying) lives in one sorted set, scored by
+#    priority band + available_after (epoch ms): all high jobs sort before all low
+#    ones, and within a band jobs run in the order they become due. A retry is
+#    just a future score. 1e13 ms is ~year 2286, so the bands never overlap.
+READY_KEY = "jobs:ready"
+PRIORITY_BAND = {"high": 0, "low": 10 ** 13}
+# The API pushes a token here on every submission so idle workers wake immediately
+NOTIFY_KEY = "jobs:notify"
+
+# 6) Reliable queue: fetched ids are moved into this worker's private list and
+#    only LREMed once the job reaches a final state, so a crash never loses a job.
+#    Pin WORKER_ID in the environment to recover that list after a restart.
+WORKER_ID = os.getenv("WORKER_ID") or uuid.uuid4().hex
+PROCESSING_KEY = f"jobs:processing:{WORKER_ID}"
+
+# 7) Fetched ids wait in a local buffer of WORKER_PREFETCH slots; it is only
+#    topped up once it drains to this low-watermark
+PREFETCH_LOW_WATERMARK = WORKER_PREFETCH // 2
+
+# 8) Lua script that moves up to ARGV[5] due job_ids (high band first, then low)
+#    from READY_KEY into PROCESSING_KEY, atomically and in one round-trip.
+#    KEYS = ready set, processing list
+#    ARGV = high band min/max score, low band min/max score (max = band + now), max ids
+FETCH_JOBS_LUA = """
+local moved = {}
+local count = tonumber(ARGV[5])
+for i = 1, 3, 2 do
+    if #moved >= count then break end
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[i], ARGV[i + 1], 'LIMIT', 0, count - #moved)
+    for _, job_id in ipairs(due) do
+        redis.call('ZREM', KEYS[1], job_id)
+        redis.call('LPUSH', KEYS[2], job_id)
+        moved[#moved + 1] = job_id
+    end
+end
+return moved
+"""
+
+# 9) Lua script that loads a fetched job and claims it in one atomic round-trip.
+#    KEYS[1] = jobs:hash:{job_id}; KEYS[2] = PROCESSING_KEY
+#    ARGV[1] = job_id; ARGV[2] = now (epoch ms)
+#    Returns nil if the hash is missing (the id is dropped from PROCESSING_KEY),
+#    otherwise sets status="processing" and picked_ts and returns the job hash
+#    as read just before that write, as a flat field/value list.
+#    The advisory status/picked_ts write rides along with the hash read the worker
+#    needs anyway, so it costs no round-trip of its own. CLIENT REPLY OFF/SKIP is
+#    deliberately not used: on a pooled connection redis-py would still wait for
+#    the suppressed reply, and the next caller would read the wrong one.
+CLAIM_JOB_LUA = """
+local job = redis.call('HGETALL', KEYS[1])
+if #job == 0 then
+    redis.call('LREM', KEYS[2], 1, ARGV[1])
+    return nil
+end
+redis.call('HSET', KEYS[1], 'status', 'processing', 'picked_ts', ARGV[2])
+return job
+"""
+# register_script caches the SHA and calls EVALSHA, reloading on NOSCRIPT
+_fetch_jobs_script = r.register_script(FETCH_JOBS_LUA)
+_claim_job_script = r.register_script(CLAIM_JOB_LUA)
+
+def _current_utc_ms() -> int:
+    return int(time.time() * 1000)
+
+def _ready_score(priority: str, available_after_ms: int) -> int:
+    return PRIORITY_BAND[priority] + available_after_ms
+
+async def _fetch_job_ids(count: int) -> list[str]:
     """
-    Attempt to pop from high-priority queue first; if empty, pop from low.
-    Returns job_id (string) or None if both are empty.
+    Move up to `count` due job_ids into PROCESSING_KEY, high priority first,
+    in a single round-trip (see FETCH_JOBS_LUA).
+    If nothing is due, block on NOTIFY_KEY (BLPOP) for up to FETCH_TIMEOUT
+    seconds so a new submission is picked up on the next call immediately.
+    Returns the fetched job_ids (empty if nothing was due).
     """
-    job_id = r.rpop("jobs:queue:high")
-    if job_id:
-        return job_id
-    job_id = r.rpop("jobs:queue:low")
-    return job_id  # could be None
+    now = _current_utc_ms()
+    high, low = PRIORITY_BAND["high"], PRIORITY_BAND["low"]
+    job_ids = await _fetch_jobs_script(
+        keys=[READY_KEY, PROCESSING_KEY],
+        args=[high, high + now, low, low + now, count]
+    )
+    if not job_ids:
+        await r.blpop([NOTIFY_KEY], timeout=FETCH_TIMEOUT)
+    return job_ids
 
-def _get_job_hash(job_id: str) -> dict[str, str] | None:
+async def _claim_job(job_id: str) -> dict[str, str | bytes] | None:
     """
-    Return the Redis hash for this job_id, or None if not found.
+    Run CLAIM_JOB_LUA for this job_id (through r_raw, as the hash holds MessagePack bytes).
+    Returns the job hash (status/picked_ts as they were before the claim), or None if not found.
     """
     job_key = f"jobs:hash:{job_id}"
-    if not r.exists(job_key):
+    res = await _claim_job_script(
+        keys=[job_key, PROCESSING_KEY], args=[job_id, _current_utc_ms()], client=r_raw
+    )
+    if res is None:
         return None
-    return r.hgetall(job_key)
+    # Every field is UTF-8 text except payload, which stays as MessagePack bytes
+    return {
+        k.decode(): v if k == b"payload" else v.decode()
+        for k, v in zip(res[::2], res[1::2])
+    }
 
-def _should_run(job: dict[str, str]) -> bool:
+async def _recover_orphaned_jobs() -> None:
     """
-    Compare job['available_after'] vs. now.
-    Return True if now >= available_after, else False.
+    Move any job_ids left in PROCESSING_KEY by a crashed run back into READY_KEY
+    with status="pending". Their available_after is already past, so they are
+    due at once and sort ahead of newer jobs in their band.
     """
-    avail = datetime.datetime.fromisoformat(job["available_after"])
-    return avail <= datetime.datetime.utcnow()
+    for job_id in await r.lrange(PROCESSING_KEY, 0, -1):
+        job_key = f"jobs:hash:{job_id}"
+        priority, available_after = await r.hmget(job_key, "priority", "available_after")
+        pipe = r.pipeline()
+        if priority:
+            pipe.hset(job_key, "status", "pending")
+            pipe.zadd(READY_KEY, {job_id: _ready_score(priority, int(available_after))})
+        pipe.lrem(PROCESSING_KEY, 1, job_id)
+        await pipe.execute()
+        print(f"[Worker] Recovered orphaned job {job_id}.")
 
-def _update_job_field(job_id: str, field: str, value: str) -> None:
-    """
-    Set a single field in the job's Redis hash.
-    """
-    job_key = f"jobs:hash:{job_id}"
-    r.hset(job_key, field, value)
+# Long messages are stored zstd-compressed by the API (payload_enc="zstd")
+_zstd_decompressor = zstandard.ZstdDecompressor()
 
-def _requeue_job(job_id: str, priority: str) -> None:
+async def _send_email(payload: dict) -> None:
     """
-    LPUSH job_id back into the appropriate queue.
-    Since the worker does RPOP, LPUSH puts it at the tail (i.e., oldest).
+    Send the email through SMTP_HOST with aiosmtplib (STARTTLS when offered),
+    or, if SMTP_HOST is unset, simulate it: sleep 2s + 20% random failure.
+    Either way the I/O wait is awaited, so other jobs keep running meanwhile.
+    Raises on failure.
     """
-    if priority == "high":
-        r.lpush("jobs:queue:high", job_id)
-    else:
-        r.lpush("jobs:queue:low", job_id)
+    if not SMTP_HOST:
+        await asyncio.sleep(2)  # simulate work
+        if random.random() < 0.2:
+            raise Exception("Simulated random failure")
+        return
+
+    message = EmailMessage()
+    message["From"] = SMTP_FROM
+    message["To"] = payload["to"]
+    message["Subject"] = payload["subject"]
+    message.set_content(payload["message"])
+    await aiosmtplib.send(
+        message, hostname=SMTP_HOST, port=SMTP_PORT,
+        username=SMTP_USERNAME, password=SMTP_PASSWORD
+    )
 
-def process_job(job_id: str) -> None:
+async def process_job(job_id: str) -> None:
     """
-    1) Load job hash
-    2) If not ready (available_after > now), requeue and return
-    3) Mark status="processing", set picked_ts
-    4) Simulate send_email: sleep 2s + 20% random failure
+    1-3) Atomically load job hash, mark status="processing" and set picked_ts (see CLAIM_JOB_LUA)
+    4) Send the email (see _send_email; simulated unless SMTP_HOST is set)
     5) On success: set status="completed", completed_ts
-    6) On failure: increment retry_count, if <3 schedule next backoff & requeue; else mark failed
+    6) On failure: increment retry_count, if <3 schedule next backoff in READY_KEY; else mark failed
+    Each final state transition is one pipeline that also LREMs the job from PROCESSING_KEY.
     """
     job_key = f"jobs:hash:{job_id}"
-    job = _get_job_hash(job_id)
+    job = await _claim_job(job_id)
     if job is None:
         print(f"[Worker] Job {job_id} not found. Skipping.")
         return
 
-    # 2) Check backoff
-    if not _should_run(job):
-        _requeue_job(job_id, job["priority"])
-        return
-
-    # 3) Mark as processing
-    _update_job_field(job_id, "status", "processing")
-    _update_job_field(job_id, "picked_ts", _current_utc_iso())
-
-    # 4) Simulate send_email
+    # 4) send_email
     try:
-        payload = json.loads(job["payload"])
+        payload = msgpack.unpackb(job["payload"], raw=False)
+        if job.get("payload_enc") == "zstd":
+            payload["message"] = _zstd_decompressor.decompress(payload["message"]).decode()
         print(f"[Worker] Processing job {job_id} → sending email to {payload['to']} ...")
-        time.sleep(2)  # simulate work
-
-        # Simulate 20% chance of failure
-        if random.random() < 0.2:
-            raise Exception("Simulated random failure")
+        await _send_email(payload)
 
         # Success:
-        _update_job_field(job_id, "status", "completed")
-        _update_job_field(job_id, "completed_ts", _current_utc_iso())
+        pipe = r.pipeline()
+        pipe.hset(job_key, mapping={"status": "completed", "completed_ts": str(_current_utc_ms())})
+        pipe.lrem(PROCESSING_KEY, 1, job_id)
+        await pipe.execute()
         print(f"[Worker] Job {job_id} COMPLETED successfully.")
 
     except Exception:
         # 5) Failure path: increment retry_count
         old_retries = int(job["retry_count"])
         new_retries = old_retries + 1
-        _update_job_field(job_id, "retry_count", str(new_retries))
 
         if new_retries < 3:
             # Schedule a retry with exponential backoff
             delay_secs = BACKOFF_BASE * (2 ** (new_retries - 1))  # 1s, 2s, 4s
-            next_avail = (datetime.datetime.utcnow() + datetime.timedelta(seconds=delay_secs)).isoformat()
-            _update_job_field(job_id, "status", "pending")
-            _update_job_field(job_id, "available_after", next_avail)
-            _requeue_job(job_id, job["priority"])
+            next_avail = _current_utc_ms() + delay_secs * 1000
+            # Update the hash and re-add it to READY_KEY with a future score
+            # in one round-trip; FETCH_JOBS_LUA skips it until it is due
+            pipe = r.pipeline()
+            pipe.hset(job_key, mapping={
+                "status": "pending",
+                "retry_count": str(new_retries),
+                "available_after": str(next_avail)
+            })
+            pipe.zadd(READY_KEY, {job_id: _ready_score(job["priority"], next_avail)})
+            pipe.lrem(PROCESSING_KEY, 1, job_id)
+            await pipe.execute()
             print(
                 f"[Worker] Job {job_id} FAILED (attempt {new_retries}). "
-                f"Retrying after {delay_secs}s at {next_avail}."
+                f"Retrying after {delay_secs}s."
             )
         else:
             # Permanent failure
-            _update_job_field(job_id, "status", "failed")
-            _update_job_field(job_id, "completed_ts", _current_utc_iso())
+            pipe = r.pipeline()
+            pipe.hset(job_key, mapping={
+                "status": "failed",
+                "retry_count": str(new_retries),
+                "completed_ts": str(_current_utc_ms())
+            })
+            pipe.lrem(PROCESSING_KEY, 1, job_id)
+            await pipe.execute()
             print(f"[Worker] Job {job_id} PERMANENTLY FAILED after {new_retries} attempts.")
 
+async def _consume(buffer: asyncio.Queue, refill: asyncio.Event) -> None:
+    """
+    One of WORKER_CONCURRENCY job slots: take job_ids from the local buffer
+    and run them, asking the fetcher for more once the buffer runs low.
+    If a job dies on an unexpected error, its job_id stays in PROCESSING_KEY
+    and is recovered on the next start.
+    """
+    while True:
+        job_id = await buffer.get()
+        if buffer.qsize() <= PREFETCH_LOW_WATERMARK:
+            refill.set()
+        try:
+            await process_job(job_id)
+        except Exception as exc:
+            print(f"[Worker] Job {job_id} crashed: {exc!r}")
 
-if __name__ == "__main__":
-    print("[Worker] Starting worker loop. Listening for jobs...")
+async def main() -> None:
+    """
+    Fetch job_ids in batches sized to the free room in the local buffer,
+    and only once it has drained to PREFETCH_LOW_WATERMARK, so the worker
+    never takes much more work off READY_KEY than it can start immediately.
+    """
+    print(
+        f"[Worker] Starting worker {WORKER_ID} (concurrency {WORKER_CONCURRENCY}, "
+        f"prefetch {WORKER_PREFETCH}). Listening for jobs..."
+    )
+    await _recover_orphaned_jobs()
+    buffer: asyncio.Queue = asyncio.Queue(maxsize=WORKER_PREFETCH)
+    refill = asyncio.Event()
+    refill.set()
+    # keep references so the consumer tasks aren't garbage-collected
+    consumers = [asyncio.create_task(_consume(buffer, refill)) for _ in range(WORKER_CONCURRENCY)]
     while True:
-        job_id = _fetch_next_job_id()
-        if job_id:
-            process_job(job_id)
-        else:
-            time.sleep(1)
+        await refill.wait()
+        refill.clear()
+        for job_id in await _fetch_job_ids(buffer.maxsize - buffer.qsize()):
+            buffer.put_nowait(job_id)
+        # Fewer jobs were due than a full batch: keep fetching (BLPOP paces an idle loop)
+        if buffer.qsize() <= PREFETCH_LOW_WATERMARK:
+            refill.set()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())